@@ -1,5 +1,16 @@
 import json
 import argparse
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 from nl2sqleval import generate_report, print_report
 from nl2sqleval.database import Database
@@ -28,18 +39,35 @@ def parse_arguments():
     return parser.parse_args()
 
 
+def load_queries(path):
+    """Load the queries from a JSON file.
+
+    The file is parsed with orjson if it is installed, otherwise it is streamed one record at a time with ijson
+    if that is installed, and parsed with the standard json module as a last resort.
+    """
+    if orjson is not None:
+        return orjson.loads(Path(path).read_bytes())
+    if ijson is None:
+        with open(path, 'rb') as f:
+            return json.load(f)
+    return stream_queries(path)
+
+
+def stream_queries(path):
+    with open(path, 'rb') as f:
+        yield from ijson.items(f, 'item')
+
+
 if __name__ == '__main__':
     args = parse_arguments()
 
-    database = Database(args.db_path)
+    database = Database(args.db_path, read_only=True)
 
     # Load the expected queries from the specified file
-    with open(args.expected_queries_path, 'r') as f:
-        expected_queries = json.load(f)
+    expected_queries = load_queries(args.expected_queries_path)
 
     # Load the generated queries from the specified file
-    with open(args.generated_queries_path, 'r') as f:
-        generated_queries = json.load(f)
+    generated_queries = load_queries(args.generated_queries_path)
 
     # Compare the queries
     report = generate_report(
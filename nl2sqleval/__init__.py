@@ -1,3 +1,3 @@
-from .sql_compare import compare_queries, validate_query, compare_results
+from .sql_compare import compare_queries, compare_queries_batch, validate_query, compare_results, execute_and_compare
 from .report import generate_report, print_report
 from .database import Database
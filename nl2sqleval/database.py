@@ -1,21 +1,162 @@
 import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# Connection settings for the read-heavy evaluation workload: temporary tables in memory, a 256 MiB page cache and
+# memory-mapped I/O. They only apply to the connection, nothing is stored in the database file
+PRAGMAS = (
+    'temp_store=MEMORY',
+    'cache_size=-262144',
+    'mmap_size=268435456',
+)
+
+# Maximum number of query results cached per connection
+RESULT_CACHE_SIZE = 2048
 
 
 class Database:
-    def __init__(self, db_path):
+    """SQLite database with one connection per thread.
+
+    Connections are opened lazily by the thread that uses them, so the same Database object can be shared by
+    the worker threads of a thread pool. If read_only is set, the connections are opened in read-only mode
+    and share their page cache.
+    Note that an in-memory database (':memory:') is private to each connection and thus to each thread.
+    """
+
+    def __init__(self, db_path, read_only=False):
         self.db_path = db_path
-        self.connection = None
+        self.read_only = read_only
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def in_memory(self):
+        """Whether the database only exists within each connection (in-memory or temporary database)."""
+        return str(self.db_path) in ('', ':memory:')
+
+    @property
+    def connection(self):
+        """The connection of the calling thread, None until the thread connected."""
+        return getattr(self._local, 'connection', None)
+
+    @connection.setter
+    def connection(self, connection):
+        self._local.connection = connection
+        self._local.cursor = None
+        self._local.results = OrderedDict()
+        self._local.results_version = None
+        if connection is not None:
+            with self._lock:
+                self._connections.append((threading.current_thread(), connection))
 
     def connect(self):
-        self.connection = sqlite3.connect(self.db_path)
-        return self.connection
+        if self.read_only:
+            connection = self.open_ro_connection()
+        else:
+            connection = sqlite3.connect(self.db_path, cached_statements=512, check_same_thread=False)
+            self._apply_pragmas(connection)
+
+        self.connection = connection
+        return connection
+
+    def open_ro_connection(self):
+        """Open a new read-only connection in shared-cache mode.
+
+        The read-only connections to the same database share one page cache, so pages read by one thread are
+        served from memory to the others.
+        """
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro&cache=shared"
+        connection = sqlite3.connect(uri, uri=True, cached_statements=512, check_same_thread=False)
+        self._apply_pragmas(connection)
+        return connection
+
+    @staticmethod
+    def _apply_pragmas(connection):
+        for pragma in PRAGMAS:
+            connection.execute(f'PRAGMA {pragma}')
 
     def close(self):
-        if self.connection:
-            self.connection.close()
-            self.connection = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for _, connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def close_finished_threads_connections(self):
+        """Close the connections of the threads that have finished, e.g. the workers of a thread pool that was shut
+        down. The connections of the running threads stay open."""
+        with self._lock:
+            finished = [connection for thread, connection in self._connections if not thread.is_alive()]
+            self._connections = [(thread, connection) for thread, connection in self._connections if thread.is_alive()]
+        for connection in finished:
+            connection.close()
 
     def get_cursor(self):
         if not self.connection:
             self.connect()
-        return self.connection.cursor()
\ No newline at end of file
+        return self.connection.cursor()
+
+    def _cursor(self):
+        """Return the cursor of the calling thread used by the package to execute its queries.
+
+        It is created once per connection and reused, the cursors returned by get_cursor are not affected by it.
+        """
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self._local.cursor = self.get_cursor()
+        return cursor
+
+    def _data_version(self, cursor):
+        """Return a value that changes whenever the data or the schema seen by the connection of the cursor change.
+
+        Changes made through the connection itself are counted by total_changes (data) and schema_version (schema),
+        changes committed by other connections or processes by data_version.
+        """
+        return (
+            cursor.connection.total_changes,
+            cursor.execute('PRAGMA data_version').fetchone()[0],
+            cursor.execute('PRAGMA schema_version').fetchone()[0],
+        )
+
+    def fetch_all(self, query):
+        """Execute a query and fetch all of its rows.
+
+        The rows of queries returning rows without modifying the database are cached per connection, keyed by the
+        SQL string, so repeated queries (e.g. the same expected query across an evaluation set) are executed only
+        once. The cache is cleared as soon as the database changed, whether through this object or not.
+
+        Nothing is cached while the connection has a transaction open, as its changes may still be rolled back.
+        Queries with non-deterministic results (e.g. random() or date('now')) are cached like any other query.
+        """
+        cursor = self._cursor()
+        results = self._local.results
+        if cursor.connection.in_transaction:
+            # The uncommitted changes are not reflected by the version, the cache is rebuilt after the transaction
+            results.clear()
+            self._local.results_version = None
+            return cursor.execute(query).fetchall()
+
+        version = self._data_version(cursor)
+        if version != self._local.results_version:
+            results.clear()
+            self._local.results_version = version
+
+        rows = results.get(query)
+        if rows is not None:
+            results.move_to_end(query)
+            return list(rows)
+
+        rows = cursor.execute(query).fetchall()
+        # Statements without result columns (DML, DDL) are not cached, nor are statements that changed rows
+        # (e.g. DML with a RETURNING clause) or opened a transaction
+        if (
+                cursor.description is not None
+                and cursor.connection.total_changes == version[0]
+                and not cursor.connection.in_transaction
+        ):
+            results[query] = tuple(rows)
+            if len(results) > RESULT_CACHE_SIZE:
+                results.popitem(last=False)
+        return rows
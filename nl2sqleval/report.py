@@ -1,14 +1,18 @@
-from statistics import mean
+import sys
 from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from .sql_compare import compare_queries, validate_query, compare_results
+from .sql_compare import compare_queries_batch, execute_and_compare
 from .database import Database
 
 
 def generate_report(
-        expected_queries: list[dict],
-        generated_queries: list[dict],
-        database: Database
+        expected_queries: Iterable[dict],
+        generated_queries: Iterable[dict],
+        database: Database,
+        max_workers: int = 1
 ) -> list:
     """Generate comparison report from expected and generated queries.
     Take in a list of expected and generated queries and:
@@ -18,27 +22,47 @@ def generate_report(
         - track errors that occur during query execution
 
     Args:
-        expected_queries (list): List of expected queries as dictionaries containing 'question' and 'query' keys
-        generated_queries (list): List of generated queries as dictionaries containing 'question' and 'query' keys
+        expected_queries (Iterable): Expected queries as dictionaries containing 'question' and 'query' keys
+        generated_queries (Iterable): Generated queries as dictionaries containing 'question' and 'query' keys
+            (both can be lazy iterables, e.g. streamed from a file, only the questions and queries are kept)
         database (Database): Database object to execute the queries
+        max_workers (int): Maximum number of worker processes comparing the queries and of worker threads executing
+            them, each thread using its own database connection (default: 1, no parallelism; None: number of CPUs).
+            The worker processes are started anew for each report and do not share the parsing and comparison
+            caches. An in-memory database exists only within its connection, so its queries are always executed
+            sequentially
 
     Returns:
         list: List of dictionaries containing the comparison results
     """
-    report = []
+    questions = []
+    expected_sqls = []
+    generated_sqls = []
     for expected_query, generated_query in zip(expected_queries, generated_queries):
-        question = expected_query['question']
-        expected_sql = expected_query['query']
-        generated_sql = generated_query['query']
-
-        # Compare the queries and highlight the differences
-        token_similarity_score, changes, string_comparison = compare_queries(expected_sql, generated_sql)
+        questions.append(expected_query['question'])
+        # Repeated queries share one interned string, so equality checks and cache lookups hit the identity fast path
+        expected_sqls.append(sys.intern(expected_query['query']))
+        generated_sqls.append(sys.intern(generated_query['query']))
+
+    # Compare the queries and highlight the differences (CPU-bound, in worker processes)
+    query_comparisons = compare_queries_batch(zip(expected_sqls, generated_sqls), max_workers)
+
+    execute = partial(execute_and_compare, database=database)
+    if max_workers == 1 or database.in_memory:
+        executions = list(map(execute, expected_sqls, generated_sqls))
+    else:
+        # Execute the queries once to validate the generated query and compare the results (I/O-bound, in threads)
+        with ThreadPoolExecutor(max_workers) as executor:
+            executions = list(executor.map(execute, expected_sqls, generated_sqls))
+        # The worker threads have finished, their connections are no longer used
+        database.close_finished_threads_connections()
 
-        # Validate the generated query
-        valid_query = validate_query(generated_sql, database)
-
-        # Compare the results of the queries
-        same_results, expected_result, generated_result = compare_results(expected_sql, generated_sql, database)
+    report = []
+    for question, expected_sql, generated_sql, query_comparison, execution in zip(
+            questions, expected_sqls, generated_sqls, query_comparisons, executions
+    ):
+        token_similarity_score, changes, string_comparison = query_comparison
+        valid_query, same_results, expected_result, generated_result = execution
 
         # Track errors that occur during query execution
         if isinstance(expected_result, dict):
@@ -71,11 +95,21 @@ def generate_report(
     return report
 
 
+# Approximate size of the chunks in which print_report writes the report to stdout
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# Assign weights to different change types (adjust as needed)
+CHANGE_WEIGHTS = {'Insert': 1, 'Remove': 2}
+
+
 def calculate_change_similarity_score(changes: list[tuple]) -> float:
-    # Assign weights to different change types (adjust as needed)
-    weights = {'Insert': 1, 'Remove': 2}
-    weighted_changes = sum(weights.get(change[1], 1) for change in changes)
-    max_weighted_changes = len(changes) * max(weights.values())
+    return _change_similarity_score(Counter(change[1] for change in changes))
+
+
+def _change_similarity_score(change_counts: Counter) -> float:
+    """Calculate the change similarity score from the number of changes of each type."""
+    weighted_changes = sum(CHANGE_WEIGHTS.get(change_type, 1) * count for change_type, count in change_counts.items())
+    max_weighted_changes = sum(change_counts.values()) * max(CHANGE_WEIGHTS.values())
     if max_weighted_changes == 0 or weighted_changes == 0:
         return 0.0
     return 1 - (weighted_changes / max_weighted_changes)
@@ -99,71 +133,90 @@ def print_report(report: list):
             - expected_error
             - generated_error
     """
-    valid_queries = [comparison for comparison in report if comparison['valid_query']]
-    queries_with_same_results = [comparison for comparison in report if comparison['same_results'] is True]
-    queries_with_partially_matching_results = [
-        comparison for comparison in report if 'partial' in str(comparison['same_results'])
-    ]
-    expected_errors = [comparison['expected_error'] for comparison in report if comparison['expected_error']]
-    generated_errors = [comparison['generated_error'] for comparison in report if comparison['generated_error']]
+    # Collect the statistics in a single pass over the report
+    num_valid_queries = 0
+    num_queries_with_same_results = 0
+    num_queries_with_partially_matching_results = 0
+    num_expected_errors = 0
+    num_generated_errors = 0
+    total_changes = 0
+    change_types = Counter()
+    change_similarity_score_sum = 0.0
+    similarity_score_sum = 0.0
+    for comparison in report:
+        if comparison['valid_query']:
+            num_valid_queries += 1
+            total_changes += len(comparison['changes'])
+            change_counts = Counter(change[1] for change in comparison['changes'])
+            change_types.update(change_counts)
+            change_similarity_score_sum += _change_similarity_score(change_counts)
+            similarity_score_sum += comparison['query_token_similarity_score']
+        if comparison['same_results'] is True:
+            num_queries_with_same_results += 1
+        if 'partial' in str(comparison['same_results']):
+            num_queries_with_partially_matching_results += 1
+        if comparison['expected_error']:
+            num_expected_errors += 1
+        if comparison['generated_error']:
+            num_generated_errors += 1
 
     total_queries = len(report)
-    num_valid_queries = len(valid_queries)
-    num_queries_with_same_results = len(queries_with_same_results)
-    num_queries_with_partially_matching_results = len(queries_with_partially_matching_results)
 
     percentage_valid_queries = (num_valid_queries / total_queries) * 100
     percentage_queries_with_same_results = (num_queries_with_same_results / total_queries) * 100
 
-    # Calculate average number of changes per query
-    all_changes = [result['changes'] for result in valid_queries]
-    total_changes = sum(len(changes) for changes in all_changes)
-    average_changes_per_query = total_changes / num_valid_queries if num_valid_queries > 0 else 0
-
-    # Calculate distribution of change types
-    change_types = Counter()
-    for changes in all_changes:
-        for change in changes:
-            change_types[change[1]] += 1
-
-    # Calculate change similarity score
-    change_similarity_scores = [calculate_change_similarity_score(result['changes']) for result in valid_queries]
-    average_change_similarity_score = mean(change_similarity_scores) if change_similarity_scores else 0.0
-
-    similarity_scores = [r['query_token_similarity_score'] for r in valid_queries]
-    average_similarity_score = mean(similarity_scores) if similarity_scores else 0.0
-
+    # Calculate average number of changes, change similarity score and similarity score per valid query
+    if num_valid_queries > 0:
+        average_changes_per_query = total_changes / num_valid_queries
+        average_change_similarity_score = change_similarity_score_sum / num_valid_queries
+        average_similarity_score = similarity_score_sum / num_valid_queries
+    else:
+        average_changes_per_query = 0
+        average_change_similarity_score = 0.0
+        average_similarity_score = 0.0
+
+    # Build the output and write it in chunks instead of issuing one print() call per line
+    out = []
+    out_size = 0
     for result in report:
-        print("------")
-        print(f"Question: {result['question']}")
-        print(f"Expected SQL: {result['expected']}")
-        print(f"Comparison string:\n{result['comparison_string']}")
-        print(f"Generated SQL: {result['generated']}")
-        print(f"Valid query: {result['valid_query']}")
-        print(f"Same results: {result['same_results']}")
-        print(f"Expected error: {result['expected_error']}")
-        print(f"Generated error: {result['generated_error']}")
-        print(f'Similarity score: {result["query_token_similarity_score"]:.2f}')
-        print(f'Changes: {result["changes"]}')
-
-    print(f"\nPercentage of valid queries: {percentage_valid_queries:.2f}%")
-    print(f"Percentage of queries with same results: {percentage_queries_with_same_results:.2f}%")
-    print(f"Average similarity score: {average_similarity_score:.2f}")
-    print('------')
-
-    print('Change statistics:')
-    print(f"Total number of changes: {total_changes}")
-    print(f"Average number of changes per query: {average_changes_per_query:.2f}")
-    print(f"Change distribution: {change_types}")
-    print(f"Average change similarity score: {average_change_similarity_score:.2f}")
-    print('------')
-
-    print(f"Number of valid queries: {num_valid_queries}/{total_queries}")
-    print(f"Number of queries with same results: {num_queries_with_same_results}/{total_queries}")
-    print(
+        entry_start = len(out)
+        out.append("------")
+        out.append(f"Question: {result['question']}")
+        out.append(f"Expected SQL: {result['expected']}")
+        out.append(f"Comparison string:\n{result['comparison_string']}")
+        out.append(f"Generated SQL: {result['generated']}")
+        out.append(f"Valid query: {result['valid_query']}")
+        out.append(f"Same results: {result['same_results']}")
+        out.append(f"Expected error: {result['expected_error']}")
+        out.append(f"Generated error: {result['generated_error']}")
+        out.append(f'Similarity score: {result["query_token_similarity_score"]:.2f}')
+        out.append(f'Changes: {result["changes"]}')
+
+        out_size += sum(map(len, out[entry_start:]))
+        if out_size >= OUTPUT_CHUNK_SIZE:
+            sys.stdout.write("\n".join(out) + "\n")
+            out.clear()
+            out_size = 0
+
+    out.append(f"\nPercentage of valid queries: {percentage_valid_queries:.2f}%")
+    out.append(f"Percentage of queries with same results: {percentage_queries_with_same_results:.2f}%")
+    out.append(f"Average similarity score: {average_similarity_score:.2f}")
+    out.append('------')
+
+    out.append('Change statistics:')
+    out.append(f"Total number of changes: {total_changes}")
+    out.append(f"Average number of changes per query: {average_changes_per_query:.2f}")
+    out.append(f"Change distribution: {change_types}")
+    out.append(f"Average change similarity score: {average_change_similarity_score:.2f}")
+    out.append('------')
+
+    out.append(f"Number of valid queries: {num_valid_queries}/{total_queries}")
+    out.append(f"Number of queries with same results: {num_queries_with_same_results}/{total_queries}")
+    out.append(
         "Number of queries with partially matching results: "
         f"{num_queries_with_partially_matching_results}/{total_queries}"
     )
-    print(f"Ratio of generated/expected errors: {len(generated_errors)}/{len(expected_errors)}")
-    print("------")
+    out.append(f"Ratio of generated/expected errors: {num_generated_errors}/{num_expected_errors}")
+    out.append("------")
 
+    sys.stdout.write("\n".join(out) + "\n")
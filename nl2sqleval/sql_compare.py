@@ -1,15 +1,40 @@
 import difflib
 import sqlite3
 import logging
+import sys
 import sqlparse
 import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from functools import lru_cache, partial
+from collections.abc import Iterable
+from typing import Optional
 
 import sqlglot
 from sqlglot import parse_one, exp, diff as sqlglot_diff
 from sqlglot.optimizer import optimize
 
+try:
+    import rapidfuzz
+except ImportError:
+    rapidfuzz = None
+
 from .database import Database
 
+# Clause types compared by compare_clauses
+CLAUSE_TYPES = (exp.Select, exp.From, exp.Where, exp.Group, exp.Having, exp.Order, exp.Limit)
+
+# Runs of whitespace, collapsed to a single space in the comparison string, and the quoted string literals and
+# identifiers, kept as they are
+WHITESPACE_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)|\s+""")
+
+# Characters marking the changed characters of the queries in the comparison string, by SequenceMatcher opcode
+# (a deletion only spans the expected query and an insertion only the generated query)
+DIFF_MARKERS = {'equal': ' ', 'replace': '^', 'delete': '-', 'insert': '+'}
+
+# Number of rows fetched at a time when the number of fetched rows is limited
+FETCH_BATCH_SIZE = 1024
+
 
 def extract_clauses(parsed_query: sqlglot.Expression) -> dict:
     """Extract the clauses from a parsed SQL query.
@@ -21,21 +46,26 @@ def extract_clauses(parsed_query: sqlglot.Expression) -> dict:
         dict: A dictionary containing the extracted clauses
             - the keys are the clause types (Select, From, Where, Group, Having, Order, Limit)
     """
-    clauses = {}
+    clauses = {clause_type.key: [] for clause_type in CLAUSE_TYPES}
 
-    for clause in (
-            exp.Select, exp.From, exp.Where, exp.Group, exp.Having, exp.Order, exp.Limit
-    ):
-        found_clauses = [clause.sql() for clause in parsed_query.find_all(clause)]
-        if found_clauses:
-            clauses[clause.key] = found_clauses
-    return clauses
+    # Collect all clause types in a single traversal of the query. The clauses are serialized without copying them,
+    # generating SQL in the default dialect does not modify the tree
+    for node in parsed_query.walk():
+        if isinstance(node, CLAUSE_TYPES):
+            for clause_type in CLAUSE_TYPES:
+                if isinstance(node, clause_type):
+                    clauses[clause_type.key].append(sys.intern(node.sql(copy=False)))
+                    break
+
+    return {key: found_clauses for key, found_clauses in clauses.items() if found_clauses}
 
 
 def compare_queries(
         expected: str,
         generated: str,
-        optimize_query=False
+        optimize_query=False,
+        include_diff_string=True,
+        compute_ast_diff=True
 ) -> tuple[str, list[tuple[str, str]], tuple[str, str]]:
     """Compare two queries and calculate the similarity score.
 
@@ -43,6 +73,11 @@ def compare_queries(
         expected (str): The expected query
         generated (str): The generated query
         optimize_query (bool): Whether to optimize the queries before comparing
+        include_diff_string (bool): Whether to build the string highlighting the changes (default: True),
+            if not the returned string is empty
+        compute_ast_diff (bool): Whether to compute the differences between the syntax trees of the queries
+            (default: True), if not the returned differences are empty and the queries are not diffed
+            (nor parsed, unless optimize_query is set)
 
     Returns:
         Tuple: A tuple containing:
@@ -55,64 +90,190 @@ def compare_queries(
             - where each tuple contains the highlighted difference as the actions to be taken
                 if trying to convert the expected query to the generated query
     """
+    # Identical queries need neither parsing nor diffing
+    if expected == generated:
+        return 1.0, [], ""
 
-    # Parse queries
-    expected_parsed = parse_one(expected)
-    generated_parsed = parse_one(generated)
-
-    differences_ast = sqlglot_diff(
-        expected_parsed,
-        generated_parsed
+    similarity_score, normalized_differences, diff_string = _compare_queries(
+        expected, generated, optimize_query, include_diff_string, compute_ast_diff
     )
+    return similarity_score, list(normalized_differences), diff_string
 
-    normalized_differences = [
-        (change_action.expression.sql(), change_action.__class__.__name__)
-        for change_action in differences_ast if hasattr(change_action, 'expression')
-    ]
 
-    if optimize_query:
-        try:
-            expected_normalized = optimize(expected_parsed).sql()
-            generated_normalized = optimize(generated_parsed).sql()
-        except Exception as e:
-            logging.error(f"Error optimizing queries: {e}", exc_info=True)
-            expected_normalized = expected
-            generated_normalized = generated
-
-        # Split the queries into tokens
-        expected_tokens = [str(token) for token in sqlparse.parse(expected_normalized)[0].flatten() if str(token).strip()]
-        generated_tokens = [str(token) for token in sqlparse.parse(generated_normalized)[0].flatten() if str(token).strip()]
-
-        # Calculate the similarity score
-        similarity_score = difflib.SequenceMatcher(None, expected_tokens, generated_tokens).ratio()
-    else:
+def compare_queries_batch(pairs: Iterable[tuple[str, str]], max_workers: int = 1, **kwargs) -> list:
+    """Compare many pairs of queries, optionally in parallel.
 
-        # Split the queries into tokens
-        expected_tokens = [str(token) for token in sqlparse.parse(expected)[0].flatten() if str(token).strip()]
-        generated_tokens = [str(token) for token in sqlparse.parse(generated)[0].flatten() if str(token).strip()]
+    Parsing and tokenizing the queries is pure Python and holds the GIL, so the pairs are compared in worker
+    processes rather than threads. The worker processes do not share the parsing and comparison caches.
 
-        # Calculate the similarity score
-        similarity_score = difflib.SequenceMatcher(None, expected_tokens, generated_tokens).ratio()
+    Args:
+        pairs (Iterable): Pairs of expected and generated queries
+        max_workers (int): Maximum number of worker processes (default: 1, no parallelism; None: number of CPUs)
+        **kwargs: Options passed on to compare_queries
 
-    # Highlight the differences
-    differ = difflib.Differ()
+    Returns:
+        list: The results of compare_queries, in the order of the pairs
+    """
+    expected_sqls = []
+    generated_sqls = []
+    for expected, generated in pairs:
+        expected_sqls.append(expected)
+        generated_sqls.append(generated)
 
-    # Generate the differences
-    diff = list(differ.compare([re.sub(r'\s+', ' ', expected)], [re.sub(r'\s+', ' ', generated)]))
+    compare = partial(compare_queries, **kwargs)
+    if max_workers == 1:
+        return list(map(compare, expected_sqls, generated_sqls))
+
+    with ProcessPoolExecutor(max_workers) as executor:
+        return list(executor.map(compare, expected_sqls, generated_sqls, chunksize=32))
+
+
+def _lcs_length(expected, generated) -> int:
+    """Calculate the length of the longest common subsequence of two strings or sequences of tokens.
+
+    Bit-parallel algorithm of Allison-Dix and Hyyrö: each bit of an integer stands for one element of the expected
+    sequence, so each element of the generated sequence is processed with a few integer operations instead of a row
+    of the dynamic programming table.
+    """
+    if not expected or not generated:
+        return 0
+
+    # Bit mask of the positions of each element in the expected sequence
+    position_masks = {}
+    bit = 1
+    for item in expected:
+        position_masks[item] = position_masks.get(item, 0) | bit
+        bit <<= 1
+
+    all_bits = bit - 1
+    row = all_bits
+    for item in generated:
+        matches = row & position_masks.get(item, 0)
+        row = ((row + matches) | (row - matches)) & all_bits
+
+    # Each zero bit is an element of the longest common subsequence
+    return len(expected) - bin(row).count('1')
+
+
+def _similarity(expected, generated) -> float:
+    """Calculate the similarity ratio between 0 and 1 of two strings or sequences of tokens.
+
+    The ratio is the normalized Indel similarity 2 * LCS / (len(expected) + len(generated)), calculated by RapidFuzz
+    if it is installed and by a pure Python bit-parallel LCS otherwise.
+    """
+    if rapidfuzz is None:
+        total_length = len(expected) + len(generated)
+        if not total_length:
+            return 1.0
+        return 2 * _lcs_length(expected, generated) / total_length
+    return rapidfuzz.distance.Indel.normalized_similarity(expected, generated)
+
+
+def _mean_pairwise_similarity(expected: list[str], generated: list[str]) -> float:
+    """Calculate the average similarity of the strings of two lists paired by position."""
+    num_pairs = min(len(expected), len(generated))
+    return sum(map(_similarity, expected, generated)) / num_pairs
+
+
+@lru_cache(maxsize=1024)
+def _parse_one_cached(sql: str) -> sqlglot.Expression:
+    """Parse the query with sqlglot. The parsed query is shared between callers and must not be modified."""
+    return parse_one(sql)
+
+
+@lru_cache(maxsize=512)
+def _optimize_sql(sql: str) -> Optional[str]:
+    """Optimize the query with sqlglot and return the optimized SQL, or None if the query cannot be optimized.
+
+    Failures are cached as well, so a query that cannot be optimized is only attempted and logged once.
+    """
+    try:
+        return optimize(_parse_one_cached(sql)).sql(copy=False)
+    except Exception as e:
+        logging.error(f"Error optimizing query: {e}", exc_info=True)
+        return None
+
+
+@lru_cache(maxsize=4096)
+def _tokenize(sql: str) -> tuple[str, ...]:
+    """Split the query into its sqlparse tokens, without the whitespace tokens.
+
+    The tokens are interned, so the cached token tuples share one string per distinct token (keywords,
+    identifiers, punctuation) and comparing equal tokens is an identity check.
+    """
+    return tuple(sys.intern(str(token)) for token in sqlparse.parse(sql)[0].flatten() if str(token).strip())
+
+
+def _collapse_whitespace(match: re.Match) -> str:
+    """Replace a run of whitespace matched by WHITESPACE_RE with a single space, keeping quoted text as it is."""
+    return match.group(1) or ' '
+
+
+@lru_cache(maxsize=8192)
+def _compare_queries(
+        expected: str,
+        generated: str,
+        optimize_query: bool,
+        include_diff_string: bool,
+        compute_ast_diff: bool
+) -> tuple[float, tuple, str]:
+    """Compare two queries, see compare_queries. The result is cached for repeated pairs of queries."""
+    # Split the queries into tokens, queries with the same tokens only differ in the whitespace between them
+    # (the whitespace within string literals and quoted identifiers is part of their tokens)
+    expected_tokens = _tokenize(expected)
+    generated_tokens = _tokenize(generated)
+    if expected_tokens == generated_tokens:
+        return 1.0, (), ""
+
+    normalized_differences = ()
+    if compute_ast_diff:
+        # Parse queries
+        expected_parsed = _parse_one_cached(expected)
+        generated_parsed = _parse_one_cached(generated)
+
+        differences_ast = sqlglot_diff(
+            expected_parsed,
+            generated_parsed
+        )
+
+        # The changed subtrees belong to the copies diffed by sqlglot and are serialized without copying them again
+        normalized_differences = tuple(
+            (change_action.expression.sql(copy=False), change_action.__class__.__name__)
+            for change_action in differences_ast if hasattr(change_action, 'expression')
+        )
+
+    if optimize_query:
+        expected_optimized = _optimize_sql(expected)
+        generated_optimized = _optimize_sql(generated)
+        # Compare the original queries unless both of them could be optimized
+        if expected_optimized is not None and generated_optimized is not None:
+            expected_tokens = _tokenize(expected_optimized)
+            generated_tokens = _tokenize(generated_optimized)
+
+    # Calculate the similarity score
+    similarity_score = _similarity(expected_tokens, generated_tokens)
 
-    # Build the difference visualization string
     diff_string = ""
-    for line in diff:
-        if line.startswith('- '):
-            diff_string += '-' + line[2:] + '\n'
-        elif line.startswith('+ '):
-            diff_string += '+' + line[2:] + '\n'
-        elif line.startswith('? '):
-            diff_string += ' ' + line[2:].rstrip() + '\n'
-            diff_string += '?' + ' ' * (len(line) - 3) + '^\n'
-
-    # Remove the trailing newline character
-    diff_string = diff_string.rstrip()
+    if include_diff_string:
+        # Mark the changed characters of the whitespace-normalized queries from their matching blocks
+        expected_line = WHITESPACE_RE.sub(_collapse_whitespace, expected).strip()
+        generated_line = WHITESPACE_RE.sub(_collapse_whitespace, generated).strip()
+        expected_markers = []
+        generated_markers = []
+        matcher = difflib.SequenceMatcher(None, expected_line, generated_line, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            marker = DIFF_MARKERS[tag]
+            expected_markers.append(marker * (i2 - i1))
+            generated_markers.append(marker * (j2 - j1))
+
+        # Build the difference visualization string, with the markers aligned under each query
+        diff_lines = [
+            '-' + expected_line,
+            ' ' + ''.join(expected_markers),
+            '+' + generated_line,
+            ' ' + ''.join(generated_markers)
+        ]
+        diff_string = "\n".join(line.rstrip() for line in diff_lines if line.strip())
 
     return similarity_score, normalized_differences, diff_string
 
@@ -131,8 +292,8 @@ def compare_clauses(expected: str, generated: str):
     """
     try:
         # Parse the SQL queries using sqlglot
-        expected_parsed = parse_one(expected)
-        generated_parsed = parse_one(generated)
+        expected_parsed = _parse_one_cached(expected)
+        generated_parsed = _parse_one_cached(generated)
 
         # Extract the clauses from the parsed queries
         expected_clauses = extract_clauses(expected_parsed)
@@ -142,16 +303,9 @@ def compare_clauses(expected: str, generated: str):
         clause_similarities = {}
         for clause_type in expected_clauses:
             if clause_type in generated_clauses:
-                expected_clause_list = expected_clauses[clause_type]
-                generated_clause_list = generated_clauses[clause_type]
-
-                clause_similarity_scores = []
-                for expected_clause, generated_clause in zip(expected_clause_list, generated_clause_list):
-                    clause_similarity = difflib.SequenceMatcher(None, expected_clause, generated_clause).ratio()
-                    clause_similarity_scores.append(clause_similarity)
-
-                avg_clause_similarity = sum(clause_similarity_scores) / len(clause_similarity_scores)
-                clause_similarities[clause_type] = avg_clause_similarity
+                clause_similarities[clause_type] = _mean_pairwise_similarity(
+                    expected_clauses[clause_type], generated_clauses[clause_type]
+                )
             else:
                 clause_similarities[clause_type] = 0.0
 
@@ -168,20 +322,60 @@ def compare_clauses(expected: str, generated: str):
 def validate_query(query: str, database: Database):
     """Validate the query by executing it on the database."""
     try:
-        cursor = database.get_cursor()
-        cursor.execute(query)
+        # The statement is not fetched, closing the cursor finalizes it and releases its lock on the database
+        with closing(database.get_cursor()) as cursor:
+            cursor.execute(query)
         return True
     except sqlite3.Error as e:
         print(f"Error executing query: {e}")
         return False
 
 
+def _fetch_rows(query: str, database: Database, max_rows: int) -> list:
+    """Execute a read-only query and fetch at most max_rows of its rows, in batches."""
+    # The statement may be left unfinished, closing its own cursor finalizes it and releases its lock on the database
+    with closing(database.get_cursor()) as cursor:
+        cursor.execute(query)
+        rows = []
+        while len(rows) < max_rows:
+            batch = cursor.fetchmany(min(FETCH_BATCH_SIZE, max_rows - len(rows)))
+            if not batch:
+                break
+            rows.extend(batch)
+    return rows
+
+
+def execute_query(query: str, database: Database, max_rows: int = None):
+    """Execute a query on the database and fetch all of its rows.
+
+    Args:
+        query (str): The query to execute
+        database (Database): Database object to execute the query
+        max_rows (int): Maximum number of rows to fetch of a read-only query (default: None, all rows),
+            limited fetches are not cached
+
+    Returns:
+        list | dict: The fetched rows, or a dictionary with an 'error' key in case of failure to execute the query
+
+    Results of read-only queries are cached by the database (see Database.fetch_all), so repeated queries
+    (e.g. the same expected query across an evaluation set) are executed only once as long as the database
+    does not change.
+    """
+    try:
+        if max_rows is not None:
+            return _fetch_rows(query.strip(), database, max_rows)
+        return database.fetch_all(query.strip())
+    except Exception as e:
+        return {'error': str(e)}
+
+
 def compare_results(
         expected_query: str,
         generated_query: str,
         database: Database,
         ignore_row_order=True,
-        ignore_column_order=True
+        ignore_column_order=True,
+        early_exit=False
 ):
     """Compare the results of two queries.
 
@@ -191,6 +385,8 @@ def compare_results(
         database (Database): Database object to execute the queries
         ignore_row_order (bool): Whether to ignore the order of rows in the comparison (default: True)
         ignore_column_order (bool): Whether to ignore the order of columns in the comparison (default: True)
+        early_exit (bool): Whether to stop fetching the rows of the generated query as soon as it returned more rows
+            than the expected query (default: False), the generated results are then truncated
 
     Returns:
         Tuple: A tuple containing the comparison result (True/False/partial/partial_incomplete),
@@ -202,41 +398,107 @@ def compare_results(
             - in case of failure to execute the queries, the results are returned as dictionaries with an 'error' key
 
     """
-    try:
-        cursor = database.get_cursor()
-    except Exception as e:
-        logging.error(f"Error getting cursor: {e}", exc_info=True)
-        return False, {'error': str(e)}, {'error': str(e)}
+    expected_result, generated_result = _execute_queries(expected_query, generated_query, database, early_exit)
+    return _compare_result_sets(expected_result, generated_result, ignore_row_order, ignore_column_order)
 
-    try:
-        expected_result = cursor.execute(expected_query).fetchall()
-    except Exception as e:
-        expected_result = {'error': str(e)}
 
-    try:
-        generated_result = cursor.execute(generated_query).fetchall()
-    except Exception as e:
-        generated_result = {'error': str(e)}
+def execute_and_compare(
+        expected_query: str,
+        generated_query: str,
+        database: Database,
+        ignore_row_order=True,
+        ignore_column_order=True,
+        early_exit=False
+):
+    """Execute both queries once and derive the validity of the generated query and the comparison of the results.
 
-    if 'error' in generated_result or 'error' in expected_result or len(expected_result) != len(generated_result):
-        return False, expected_result, generated_result
+    Args:
+        expected_query (str): The expected query
+        generated_query (str): The generated query
+        database (Database): Database object to execute the queries
+        ignore_row_order (bool): Whether to ignore the order of rows in the comparison (default: True)
+        ignore_column_order (bool): Whether to ignore the order of columns in the comparison (default: True)
+        early_exit (bool): Whether to stop fetching the rows of the generated query as soon as it returned more rows
+            than the expected query (default: False), the generated results are then truncated
+
+    Returns:
+        Tuple: A tuple containing:
+            - whether the generated query is valid (executes without errors)
+            - the comparison result, the expected results and the generated results as returned by compare_results
+    """
+    expected_result, generated_result = _execute_queries(expected_query, generated_query, database, early_exit)
+    valid_query = not isinstance(generated_result, dict)
 
-    if ignore_row_order:
-        expected_result = sorted(expected_result, key=lambda row: [str(item) for item in row])
-        generated_result = sorted(generated_result, key=lambda row: [str(item) for item in row])
+    same_results, expected_result, generated_result = _compare_result_sets(
+        expected_result, generated_result, ignore_row_order, ignore_column_order
+    )
+    return valid_query, same_results, expected_result, generated_result
+
+
+def _execute_queries(expected_query: str, generated_query: str, database: Database, early_exit: bool) -> tuple:
+    """Execute the expected and the generated query and return their results."""
+    expected_result = execute_query(expected_query, database)
+    # Identical queries return identical results, execute them only once
+    if generated_query == expected_query:
+        return expected_result, expected_result
+
+    max_rows = None
+    if early_exit and not isinstance(expected_result, dict):
+        # One row more than expected is enough to know that the results differ
+        max_rows = len(expected_result) + 1
+    return expected_result, execute_query(generated_query, database, max_rows)
+
+
+def _row_sort_key(row) -> tuple[str, ...]:
+    """Key ordering the rows by the string representations of their values."""
+    return tuple(map(str, row))
+
+
+def _compare_result_sets(expected_result, generated_result, ignore_row_order, ignore_column_order):
+    """Compare already fetched query results, see compare_results for the meaning of the returned tuple."""
+    if (
+            isinstance(expected_result, dict)
+            or isinstance(generated_result, dict)
+            or len(expected_result) != len(generated_result)
+    ):
+        return False, expected_result, generated_result
 
     if ignore_column_order:
-        expected_result = [sorted(str(item) for item in row) for row in expected_result]
-        generated_result = [sorted(str(item) for item in row) for row in generated_result]
+        # Convert the values to strings once, the rows of strings are ordered without a key function
+        # and then the values within each row are sorted in place
+        expected_result = [list(map(str, row)) for row in expected_result]
+        generated_result = [list(map(str, row)) for row in generated_result]
+        if ignore_row_order:
+            expected_result.sort()
+            generated_result.sort()
+        for row in expected_result:
+            row.sort()
+        for row in generated_result:
+            row.sort()
+    elif ignore_row_order:
+        # sorted computes the key of each row once, the string tuples are then compared in C
+        expected_result = sorted(expected_result, key=_row_sort_key)
+        generated_result = sorted(generated_result, key=_row_sort_key)
+
+    # Identical results are detected by a single list comparison, the rows are only inspected on a mismatch
+    if expected_result == generated_result:
+        return True, expected_result, generated_result
 
     partial_match = False
     partial_incomplete_match = False
 
     for exp_row, gen_row in zip(expected_result, generated_result):
         if exp_row != gen_row:
-            if all(str(item) in [str(i) for i in gen_row] for item in exp_row) and not partial_incomplete_match:
+            if ignore_column_order:
+                # The values were already converted to strings
+                exp_values = exp_row
+                gen_items = frozenset(gen_row)
+            else:
+                exp_values = list(map(str, exp_row))
+                gen_items = frozenset(map(str, gen_row))
+            if gen_items.issuperset(exp_values) and not partial_incomplete_match:
                 partial_match = True
-            elif any(str(item) in [str(i) for i in gen_row] for item in exp_row):
+            elif not gen_items.isdisjoint(exp_values):
                 partial_incomplete_match = True
             else:
                 return False, expected_result, generated_result
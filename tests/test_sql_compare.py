@@ -1,2 +1,161 @@
-# TODO
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
 
+from nl2sqleval import sql_compare
+from nl2sqleval.database import Database
+from nl2sqleval.sql_compare import _lcs_length, _similarity, execute_query, validate_query
+
+# RapidFuzz as imported by sql_compare, None if it is not installed
+rapidfuzz = sql_compare.rapidfuzz
+
+
+def lcs_length_reference(expected, generated):
+    """Length of the longest common subsequence by the classic dynamic programming table."""
+    previous_row = [0] * (len(generated) + 1)
+    for expected_item in expected:
+        row = [0]
+        for j, generated_item in enumerate(generated):
+            if expected_item == generated_item:
+                row.append(previous_row[j] + 1)
+            else:
+                row.append(max(previous_row[j + 1], row[j]))
+        previous_row = row
+    return previous_row[-1]
+
+
+class TestLcsLength(unittest.TestCase):
+    def test_matches_reference_on_random_sequences(self):
+        rng = random.Random(0)
+        tokens = ['SELECT', 'a', 'b', ',', 'FROM', 't', 'WHERE', '=', '1']
+        for _ in range(3000):
+            # Small alphabets produce many repeated tokens, the lengths cross several 64-bit word boundaries
+            alphabet = tokens[:rng.randint(1, len(tokens))]
+            expected = tuple(rng.choice(alphabet) for _ in range(rng.randint(0, 200)))
+            generated = tuple(rng.choice(alphabet) for _ in range(rng.randint(0, 200)))
+            self.assertEqual(_lcs_length(expected, generated), lcs_length_reference(expected, generated))
+
+    def test_strings(self):
+        self.assertEqual(_lcs_length('SELECT a FROM t', 'SELECT b FROM t'), 14)
+        self.assertEqual(_lcs_length('abcbdab', 'bdcaba'), 4)
+
+    def test_empty_sequences(self):
+        self.assertEqual(_lcs_length((), ()), 0)
+        self.assertEqual(_lcs_length((), ('a',)), 0)
+        self.assertEqual(_lcs_length(('a',), ()), 0)
+        self.assertEqual(_lcs_length('', 'abc'), 0)
+
+    def test_repeated_tokens(self):
+        self.assertEqual(_lcs_length(('a',) * 5, ('a',) * 3), 3)
+        self.assertEqual(_lcs_length(('a', 'b') * 40, ('b', 'a') * 40), 79)
+        self.assertEqual(_lcs_length(('a',) * 100, ('b',) * 100), 0)
+
+
+class TestSimilarityFallback(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(sql_compare, 'rapidfuzz', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ratio(self):
+        self.assertEqual(_similarity(('SELECT', 'a'), ('SELECT', 'b')), 0.5)
+        self.assertEqual(_similarity(('SELECT', 'a', 'FROM', 't'), ('SELECT', 'a', 'FROM', 't')), 1.0)
+
+    def test_empty_sequences(self):
+        self.assertEqual(_similarity((), ()), 1.0)
+        self.assertEqual(_similarity((), ('a',)), 0.0)
+
+    @unittest.skipIf(rapidfuzz is None, 'RapidFuzz is not installed')
+    def test_matches_rapidfuzz(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            expected = tuple(rng.choice('abcd') for _ in range(rng.randint(0, 100)))
+            generated = tuple(rng.choice('abcd') for _ in range(rng.randint(0, 100)))
+            self.assertAlmostEqual(
+                _similarity(expected, generated),
+                rapidfuzz.distance.Indel.normalized_similarity(expected, generated)
+            )
+
+
+
+class TestQueryExecution(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, 'test.sqlite')
+
+        connection = sqlite3.connect(self.db_path)
+        connection.execute('CREATE TABLE t (a INTEGER)')
+        connection.executemany('INSERT INTO t VALUES (?)', [(1,), (2,)])
+        connection.commit()
+        connection.close()
+
+        self.database = Database(self.db_path)
+        self.addCleanup(self.database.close)
+
+    def other_connection(self):
+        connection = sqlite3.connect(self.db_path)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_repeated_query(self):
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(1,), (2,)])
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(1,), (2,)])
+
+    def test_write_through_raw_connection(self):
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(1,), (2,)])
+        self.database.connection.execute('INSERT INTO t VALUES (3)')
+        self.database.connection.commit()
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(1,), (2,), (3,)])
+
+    def test_commit_from_other_connection(self):
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(1,), (2,)])
+        connection = self.other_connection()
+        connection.execute('DELETE FROM t WHERE a = 1')
+        connection.commit()
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(2,)])
+
+    def test_schema_change(self):
+        self.assertIn('error', execute_query('SELECT b FROM u', self.database))
+        connection = self.other_connection()
+        connection.execute('CREATE TABLE u (b INTEGER)')
+        connection.commit()
+        self.assertEqual(execute_query('SELECT b FROM u', self.database), [])
+        execute_query('DROP TABLE u', self.database)
+        self.assertIn('error', execute_query('SELECT b FROM u', self.database))
+
+    def test_rollback(self):
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(1,), (2,)])
+        execute_query('DELETE FROM t', self.database)
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [])
+        self.database.connection.rollback()
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(1,), (2,)])
+
+    @unittest.skipIf(sqlite3.sqlite_version_info < (3, 35, 0), 'RETURNING requires SQLite 3.35')
+    def test_returning_not_cached(self):
+        query = 'DELETE FROM t WHERE a = 1 RETURNING a'
+        self.assertEqual(execute_query(query, self.database), [(1,)])
+        self.assertEqual(execute_query(query, self.database), [])
+        self.assertEqual(execute_query('SELECT a FROM t', self.database), [(2,)])
+
+
+    def assert_writable_by_other_connection(self):
+        connection = sqlite3.connect(self.db_path, timeout=0.1)
+        self.addCleanup(connection.close)
+        connection.execute('INSERT INTO t VALUES (3)')
+        connection.commit()
+
+    def test_validate_query_releases_lock(self):
+        self.assertTrue(validate_query('SELECT a FROM t', self.database))
+        self.assert_writable_by_other_connection()
+
+    def test_limited_fetch_releases_lock(self):
+        self.assertEqual(execute_query('SELECT a FROM t', self.database, max_rows=1), [(1,)])
+        self.assert_writable_by_other_connection()
+
+
+if __name__ == '__main__':
+    unittest.main()